@@ -1,91 +1,237 @@
 import os
 import sys
 import time
+import queue
+import fnmatch
+import threading
 
 # 将父目录添加到系统路径中，以便可以从`agents`模块导入
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 try:
     # 尝试从markdown.py导入核心处理函数
-    from markdown import format_and_save_markdown
+    from markdown import (incremental_format, save_incremental_format, load_sections_manifest,
+                          SECTIONS_DIR_NAME)
 except ImportError:
-    print("错误: 无法从 'markdown.py' 导入 'format_and_save_markdown' 函数。")
+    print("错误: 无法从 'markdown.py' 导入 'incremental_format' 函数。")
     print("请确保 'agents/markdown.py' 文件存在且路径正确。")
     sys.exit(1)
 
-def batch_format_markdown():
+# 流水线默认参数
+DEFAULT_PATTERN = '*'
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024  # 字节，超过该大小的文件不会被读入内存
+DEFAULT_WORKERS = 1  # 与此前一致，默认一次只发起一个LLM请求，避免触发接口限流
+DEFAULT_QUEUE_SIZE = 64
+
+# 队列结束标记
+_DONE = object()
+
+def iter_source_files(root_dir: str, pattern: str = DEFAULT_PATTERN, max_size: int = DEFAULT_MAX_SIZE):
+    """
+    使用 `os.scandir` 递归遍历目录，逐个产出符合条件的文件，不会一次性列出整个目录。
+
+    参数:
+        root_dir (str): 要遍历的根目录。
+        pattern (str): 文件名需匹配的glob模式。
+        max_size (int): 文件大小上限（字节），为None时不限制。
+
+    产出:
+        tuple: (文件路径, 相对于root_dir的路径, (修改时间ns, 文件大小))
+    """
+    pending_dirs = [root_dir]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            entries = os.scandir(current_dir)
+        except OSError as e:
+            print(f"  无法读取目录 '{current_dir}': {e}")
+            continue
+        with entries:
+            for entry in entries:
+                # 遍历期间文件可能被删除或重命名，只跳过该条目，不影响目录中的其他文件
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(entry.path)
+                        continue
+                    if not entry.is_file() or not fnmatch.fnmatch(entry.name, pattern):
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if max_size is not None and stat.st_size > max_size:
+                    print(f"  跳过过大的文件 ({stat.st_size} 字节): {entry.path}")
+                    continue
+                yield entry.path, os.path.relpath(entry.path, root_dir), (stat.st_mtime_ns, stat.st_size)
+
+def is_up_to_date(source_stat: tuple, output_path: str, manifest_path: str) -> bool:
+    """
+    仅通过文件状态判断输出是否为最新，避免读取未变化的源文件。
+    有清单时与清单中记录的、上次实际格式化时源文件的修改时间和大小比较；
+    否则（旧版本生成的输出）与输出文件的修改时间比较。输出文件不存在时总是需要处理。
     """
-    批量处理 `processed_data` 目录下的所有文件，进行格式化，
-    并保存到 `format_data` 目录。
-    如果目标目录中已存在同名文件，则会跳过。
+    try:
+        output_mtime_ns = os.stat(output_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    manifest = load_sections_manifest(manifest_path, header_only=True)
+    if manifest:
+        return manifest.get('source_stat') == list(source_stat)
+    return source_stat[0] < output_mtime_ns
+
+def batch_format_markdown(pattern: str = DEFAULT_PATTERN, max_size: int = DEFAULT_MAX_SIZE,
+                          workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE):
+    """
+    批量处理 `processed_data` 目录（含子目录）下的所有文件，进行格式化，
+    并按相同的相对路径保存到 `format_data` 目录。
+    源文件自上次处理后未被修改的会跳过；被修改的文件只会重新格式化发生变化的章节。
     对于处理失败的文件，会进行自动重试。
+
+    处理过程是一条流水线：遍历线程发现文件 -> 多个工作线程调用LLM -> 主线程写入结果。
+    各阶段之间通过有界队列连接，下游处理不过来时上游会阻塞等待，
+    因此处理会立即开始，内存占用与目录大小无关。
+
+    参数:
+        pattern (str): 文件名需匹配的glob模式。
+        max_size (int): 文件大小上限（字节），为None时不限制。
+        workers (int): 并发调用LLM的工作线程数，默认为1。调大前请确认接口的限流额度，
+            否则限流错误在重试用尽后会导致文件处理失败。
+        queue_size (int): 每个队列的最大长度。
     """
     # 使用相对路径定位目录
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     processed_data_dir = os.path.join(base_dir, 'processed_data')
     format_data_dir = os.path.join(base_dir, 'format_data')
+    sections_dir = os.path.join(format_data_dir, SECTIONS_DIR_NAME)
+
+    if not os.path.isdir(processed_data_dir):
+        print(f"错误: 找不到目录 '{processed_data_dir}'。")
+        return
 
     # 如果输出目录不存在，则创建它
     if not os.path.exists(format_data_dir):
         os.makedirs(format_data_dir)
         print(f"已创建目录: {format_data_dir}")
 
-    try:
-        # 获取待处理文件列表
-        files_to_process = [f for f in os.listdir(processed_data_dir) if os.path.isfile(os.path.join(processed_data_dir, f))]
-        
-        # 获取目标目录中已存在的文件集合，用于快速查找
-        existing_files = set(os.listdir(format_data_dir))
-
-        if not files_to_process:
-            print(f"在 '{processed_data_dir}' 目录下未找到任何文件。")
-            return
-
-        print(f"开始批量处理 {len(files_to_process)} 个文件...")
-        processed_count = 0
-        skipped_count = 0
-        failed_files = []
-
-        # 设置重试参数
-        max_retries = 3
-        retry_delay = 1  # 秒
-
-        for filename in files_to_process:
-            if filename in existing_files:
-                skipped_count += 1
-                continue
+    # 设置重试参数
+    max_retries = 3
+    retry_delay = 1  # 秒
+
+    work_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    # 计数器只在发现线程中修改，无需加锁
+    counts = {'found': 0, 'skipped': 0, 'failed': 0}
+    # 发现线程意外中止时记录异常，用于最终汇总
+    discovery_error = []
 
-            input_path = os.path.join(processed_data_dir, filename)
-            output_path = os.path.join(format_data_dir, filename)
+    def put(q, item):
+        """放入队列，若流水线已被中止则放弃。"""
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-            print(f"正在处理: {input_path}")
-            
-            for attempt in range(max_retries):
+    def discover():
+        try:
+            for input_path, rel_path, source_stat in iter_source_files(processed_data_dir, pattern, max_size):
+                counts['found'] += 1
+                output_path = os.path.join(format_data_dir, rel_path)
+                manifest_path = os.path.join(sections_dir, f"{rel_path}.json")
                 try:
-                    format_and_save_markdown(input_path, output_path)
-                    processed_count += 1
-                    break  # 成功，跳出重试循环
+                    up_to_date = is_up_to_date(source_stat, output_path, manifest_path)
                 except Exception as e:
-                    print(f"  处理 '{filename}' 时出错 (尝试 {attempt + 1}/{max_retries}): {e}")
-                    if attempt < max_retries - 1:
-                        print(f"  将在 {retry_delay} 秒后重试...")
-                        time.sleep(retry_delay)
-                    else:
-                        print(f"  文件 '{filename}' 重试失败。")
-                        failed_files.append(filename)
-        
-        print("\n批量处理完成。")
-        print(f"成功处理: {processed_count} 个文件")
-        print(f"跳过 (已存在): {skipped_count} 个文件")
-        if failed_files:
-            print(f"处理失败的文件 ({len(failed_files)} 个):")
-            for f in failed_files:
-                print(f"  - {f}")
+                    # 单个文件的输出或清单无法读取时只记为失败，继续处理其余文件
+                    print(f"  检查 '{rel_path}' 时出错: {e}")
+                    counts['failed'] += 1
+                    continue
+                if up_to_date:
+                    counts['skipped'] += 1
+                    continue
+                if not put(work_queue, (input_path, rel_path, output_path, manifest_path)):
+                    return
+        except Exception as e:
+            print(f"错误: 遍历 '{processed_data_dir}' 时发生未知错误: {e}")
+            discovery_error.append(e)
+        finally:
+            for _ in range(workers):
+                put(work_queue, _DONE)
 
-    except FileNotFoundError:
-        print(f"错误: 找不到目录 '{processed_data_dir}'。")
-    except Exception as e:
-        print(f"发生未知错误: {e}")
+    def format_worker():
+        try:
+            while not stop_event.is_set():
+                item = work_queue.get()
+                if item is _DONE:
+                    return
+                input_path, rel_path, output_path, manifest_path = item
+                print(f"正在处理: {input_path}")
+                for attempt in range(max_retries):
+                    try:
+                        result = incremental_format(input_path, output_path, manifest_path)
+                        put(write_queue, (rel_path, output_path, manifest_path, result))
+                        break  # 成功，跳出重试循环
+                    except Exception as e:
+                        print(f"  处理 '{rel_path}' 时出错 (尝试 {attempt + 1}/{max_retries}): {e}")
+                        if attempt < max_retries - 1:
+                            print(f"  将在 {retry_delay} 秒后重试...")
+                            time.sleep(retry_delay)
+                        else:
+                            print(f"  文件 '{rel_path}' 重试失败。")
+                            put(write_queue, (rel_path, None, None, e))
+        finally:
+            put(write_queue, _DONE)
+
+    threads = [threading.Thread(target=discover, daemon=True)]
+    threads += [threading.Thread(target=format_worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    print(f"开始批量处理 '{processed_data_dir}' 下的文件...")
+    processed_count = 0
+    unchanged_count = 0
+    failed_count = 0
+    finished_workers = 0
+
+    try:
+        # 主线程负责写入，同时作为流水线的最后一级
+        while finished_workers < workers:
+            item = write_queue.get()
+            if item is _DONE:
+                finished_workers += 1
+                continue
+            rel_path, output_path, manifest_path, result = item
+            if isinstance(result, Exception):
+                failed_count += 1
+                continue
+            try:
+                save_incremental_format(output_path, manifest_path, result)
+                if result[0] is None:
+                    unchanged_count += 1
+                else:
+                    processed_count += 1
+            except Exception as e:
+                print(f"  保存 '{rel_path}' 时出错: {e}")
+                failed_count += 1
+    except KeyboardInterrupt:
+        print("\n已中断，正在停止...")
+        stop_event.set()
+        raise
+
+    if counts['found'] == 0 and not discovery_error:
+        print(f"在 '{processed_data_dir}' 目录下未找到任何文件。")
+        return
+
+    if discovery_error:
+        print(f"\n批量处理未完成: 文件遍历意外中止 ({discovery_error[0]})，其余文件未被处理。")
+    else:
+        print("\n批量处理完成。")
+    print(f"成功处理: {processed_count} 个文件")
+    print(f"跳过 (未修改): {counts['skipped'] + unchanged_count} 个文件")
+    failed_count += counts['failed']
+    if failed_count:
+        print(f"处理失败: {failed_count} 个文件 (详见上方日志)")
 
 if __name__ == '__main__':
-    batch_format_markdown()
\ No newline at end of file
+    batch_format_markdown()
@@ -2,12 +2,50 @@ from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 import sys
 import os
+import re
+import json
+import hashlib
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from llms import get_zhipu_ai_llm
 # 初始化大语言模型
 llm = get_zhipu_ai_llm()
 
+# 章节映射清单保存在输出目录下的隐藏子目录中
+SECTIONS_DIR_NAME = '.sections'
+# 章节映射清单的版本号，切分规则变化时递增以使旧清单失效
+SECTIONS_VERSION = 2
+# 无标题长文本按段落切分时，每个章节的最小/最大字符数
+SECTION_MIN_CHARS = 800
+SECTION_MAX_CHARS = 4000
+# 输出文件中各章节之间的分隔
+SECTION_SEPARATOR = '\n\n'
+
+_HEADING_RE = re.compile(r'^#{1,6}\s')
+
+prompt = ChatPromptTemplate.from_messages([
+    ("system", "你是一个文本格式化专家。你的任务是将以下文本转换为一个干净、结构良好的Markdown格式。请修正所有格式错误，并移除任何多余的字符或标记。最重要的是，绝不能改变文本的原始意义。你的输出应该只有格式化后的Markdown文本。"),
+    ("user", "{text_input}")
+])
+
+def format_markdown_text(content: str) -> str:
+    """
+    利用大语言模型将一段文本转换为格式正确的Markdown。
+
+    参数:
+        content (str): 待格式化的文本。
+
+    返回:
+        str: 经过LLM格式化后的Markdown文本。
+    """
+    chain = prompt | llm
+
+    response = chain.invoke({"text_input": content})
+
+    # LLM的响应预计会有一个'content'属性。
+    # 这可能需要根据您使用的具体LLM的返回结构进行调整。
+    return response.content if hasattr(response, 'content') else str(response)
+
 def format_markdown_from_file(file_path: str) -> str:
     """
     利用大语言模型将文本文件内容转换为格式正确的Markdown。
@@ -23,18 +61,7 @@ def format_markdown_from_file(file_path: str) -> str:
     with open(file_path, 'r', encoding='utf-8') as f:
         content = f.read()
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "你是一个文本格式化专家。你的任务是将以下文本转换为一个干净、结构良好的Markdown格式。请修正所有格式错误，并移除任何多余的字符或标记。最重要的是，绝不能改变文本的原始意义。你的输出应该只有格式化后的Markdown文本。"),
-        ("user", "{text_input}")
-    ])
-    
-    chain = prompt | llm
-    
-    response = chain.invoke({"text_input": content})
-    
-    # LLM的响应预计会有一个'content'属性。
-    # 这可能需要根据您使用的具体LLM的返回结构进行调整。
-    return response.content if hasattr(response, 'content') else str(response)
+    return format_markdown_text(content)
 
 def format_and_save_markdown(input_path: str, output_path: str = None):
     """
@@ -53,6 +80,197 @@ def format_and_save_markdown(input_path: str, output_path: str = None):
         f.write(formatted_content)
     print(f"文件已成功格式化并保存到: {output_path}")
 
+def split_sections(content: str) -> list:
+    """
+    将文本按Markdown标题切分为章节，作为增量格式化的最小单位。
+
+    代码块内的 `#` 不视为标题。超过 SECTION_MAX_CHARS 的章节（例如没有标题的长文本）
+    会在空行处继续切分，切分点由段落内容决定，因此局部修改不会使后续章节的边界整体偏移。
+
+    参数:
+        content (str): 原始文本。
+
+    返回:
+        list: 章节文本列表，空白章节会被丢弃。
+    """
+    blocks = []
+    current = []
+    in_fence = False
+    for line in content.splitlines(keepends=True):
+        if line.lstrip().startswith('```'):
+            in_fence = not in_fence
+        if not in_fence and _HEADING_RE.match(line) and current:
+            blocks.append(''.join(current))
+            current = []
+        current.append(line)
+    if current:
+        blocks.append(''.join(current))
+
+    sections = []
+    for block in blocks:
+        if len(block) <= SECTION_MAX_CHARS:
+            sections.append(block)
+            continue
+        chunk = ''
+        for paragraph in re.split(r'(?<=\n)(?=[ \t]*\n)', block):
+            chunk += paragraph
+            digest = hashlib.sha256(paragraph.strip().encode('utf-8')).digest()
+            if len(chunk) >= SECTION_MAX_CHARS or (len(chunk) >= SECTION_MIN_CHARS and digest[0] % 4 == 0):
+                sections.append(chunk)
+                chunk = ''
+        if chunk:
+            sections.append(chunk)
+
+    return [section for section in sections if section.strip()]
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha256(text.strip().encode('utf-8')).hexdigest()
+
+def _hash_output(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _write_atomic(path: str, text: str):
+    """先写入临时文件再替换，避免中断时留下半截文件。"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def load_sections_manifest(manifest_path: str, header_only: bool = False):
+    """
+    读取章节映射清单。
+
+    清单分两行：第一行是记录源文件哈希、状态和输出文件哈希的头部，
+    第二行是各章节的哈希及其在输出文件中的起止位置。
+    判断是否需要处理时只需读取很短的第一行，不必解析整个清单。
+
+    参数:
+        manifest_path (str): 章节映射清单的路径。
+        header_only (bool): 为True时只读取头部。
+
+    返回:
+        dict | None: 清单内容；文件不存在、损坏或版本不匹配时返回None。
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.loads(f.readline())
+            if not isinstance(manifest, dict) or manifest.get('version') != SECTIONS_VERSION:
+                return None
+            if not header_only:
+                manifest['sections'] = json.loads(f.readline())['sections']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+    return manifest
+
+def _dump_sections_manifest(manifest: dict) -> str:
+    header = {key: value for key, value in manifest.items() if key != 'sections'}
+    return (json.dumps(header, ensure_ascii=False) + '\n'
+            + json.dumps({'sections': manifest['sections']}, ensure_ascii=False) + '\n')
+
+def incremental_format(input_path: str, output_path: str, manifest_path: str):
+    """
+    增量格式化文件：只把相对上次运行发生变化的章节发送给LLM，
+    未变化章节直接从上次的输出文件中截取，再按原顺序拼接成完整输出。
+
+    清单记录了源文件每个章节的哈希及其在输出文件中的位置，以及读取时源文件的
+    修改时间(ns)和大小，供下次运行判断源文件是否被修改。没有可用清单，
+    或输出文件已被删除、修改时，所有章节都会被格式化，并生成新的清单供下次使用。
+    本函数不写入任何文件，结果（包括清单）由 `save_incremental_format` 保存。
+
+    参数:
+        input_path (str): 输入文件的路径。
+        output_path (str): 输出文件的路径，从中读取上次的格式化结果。
+        manifest_path (str): 章节映射清单的路径。
+
+    返回:
+        tuple: (格式化后的文本, 新清单, 发送给LLM的章节数)；文件内容未变化时格式化后的文本为None，
+            此时只需保存更新了源文件状态的清单。
+    """
+    with open(input_path, 'r', encoding='utf-8') as f:
+        # 在读取前记录状态：读取期间发生的修改会使记录值过期，下次运行仍会重新处理
+        stat = os.fstat(f.fileno())
+        content = f.read()
+
+    source_stat = [stat.st_mtime_ns, stat.st_size]
+    source_hash = _hash_text(content)
+    manifest = load_sections_manifest(manifest_path)
+    if manifest and manifest.get('source_hash') == source_hash and os.path.exists(output_path):
+        # 内容未变（仅修改时间变化），更新记录的源文件状态以便下次直接跳过
+        manifest['source_stat'] = source_stat
+        return None, manifest, 0
+
+    # 以章节哈希为键复用旧结果，章节移动位置同样可以命中。
+    # 只有输出文件与清单记录一致时，记录的位置才可信
+    previous = {}
+    if manifest:
+        try:
+            with open(output_path, 'r', encoding='utf-8') as f:
+                previous_output = f.read()
+        except FileNotFoundError:
+            previous_output = None
+        if previous_output is not None and _hash_output(previous_output) == manifest.get('output_hash'):
+            previous = {item[0]: previous_output[item[1]:item[2]] for item in manifest['sections']}
+
+    sections = []
+    pieces = []
+    position = 0
+    changed_count = 0
+    for section in split_sections(content):
+        section_hash = _hash_text(section)
+        formatted = previous.get(section_hash)
+        if formatted is None:
+            formatted = format_markdown_text(section).strip()
+            previous[section_hash] = formatted
+            changed_count += 1
+        if pieces:
+            position += len(SECTION_SEPARATOR)
+        sections.append([section_hash, position, position + len(formatted)])
+        pieces.append(formatted)
+        position += len(formatted)
+
+    formatted_content = SECTION_SEPARATOR.join(pieces) + '\n'
+    new_manifest = {
+        'version': SECTIONS_VERSION,
+        'source_hash': source_hash,
+        'source_stat': source_stat,
+        'output_hash': _hash_output(formatted_content),
+        'sections': sections,
+    }
+    return formatted_content, new_manifest, changed_count
+
+def save_incremental_format(output_path: str, manifest_path: str, result: tuple):
+    """
+    保存 `incremental_format` 的结果。
+
+    参数:
+        output_path (str): 输出文件的路径。
+        manifest_path (str): 章节映射清单的路径。
+        result (tuple): `incremental_format` 的返回值。
+    """
+    formatted_content, manifest, changed_count = result
+    if formatted_content is None:
+        _write_atomic(manifest_path, _dump_sections_manifest(manifest))
+        return
+
+    # 先写输出再写清单：若中途失败，输出哈希与旧清单不符，下次运行会重新格式化而不会截取错误内容
+    _write_atomic(output_path, formatted_content)
+    _write_atomic(manifest_path, _dump_sections_manifest(manifest))
+    print(f"文件已增量格式化并保存到: {output_path} (重新格式化 {changed_count}/{len(manifest['sections'])} 个章节)")
+
+def incremental_format_and_save(input_path: str, output_path: str, manifest_path: str) -> int:
+    """
+    增量格式化文件并保存，参见 `incremental_format`。
+
+    返回:
+        int: 本次发送给LLM的章节数，0表示文件未变化。
+    """
+    result = incremental_format(input_path, output_path, manifest_path)
+    save_incremental_format(output_path, manifest_path, result)
+    return result[2]
+
 if __name__ == '__main__':
     import random
 
@@ -70,11 +288,12 @@ if __name__ == '__main__':
         selected_file = random.choice(all_files)
         input_path = os.path.join(processed_data_dir, selected_file)
         output_path = os.path.join(format_data_dir, selected_file)
+        manifest_path = os.path.join(format_data_dir, SECTIONS_DIR_NAME, f"{selected_file}.json")
         
         print(f"随机选择的文件: {input_path}")
         
-        # 调用函数处理并保存文件
-        format_and_save_markdown(input_path, output_path)
+        # 与批量处理相同，增量格式化并记录章节映射
+        incremental_format_and_save(input_path, output_path, manifest_path)
 
     except FileNotFoundError:
         print(f"错误: 找不到目录 '{processed_data_dir}'。请确保该目录存在。")